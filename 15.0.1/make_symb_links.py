@@ -1,10 +1,97 @@
 import configparser
 import os, sys
 import ast
+import re
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-PRIORITY = []
-IGNORE = ['.git', 'setup', '.gitignore', '.idea']
+PRIORITY = frozenset()
+IGNORE = frozenset({'.git', 'setup', '.gitignore', '.idea'})
+SCAN_WORKERS = 16
 ADDONS = []
+LIST_SEPARATOR = re.compile(r'\s*,\s*')
+
+
+def split_list(value):
+    # Comma separated config values, tolerate spaces and empty items
+    return [item for item in LIST_SEPARATOR.split(value.strip()) if item]
+
+
+MANIFEST_CACHE = {}
+# Entries looked up this run, only these are saved so removed addons drop out of the cache
+MANIFEST_CACHE_USED = {}
+MANIFEST_CACHE_FILE = '.manifest_cache.json'
+
+
+def load_manifest_cache(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_CACHE_FILE)) as cache:
+            cached = json.load(cache)
+    except (OSError, ValueError):
+        return
+    if isinstance(cached, dict):
+        MANIFEST_CACHE.update(cached)
+
+
+def save_manifest_cache(cache_dir):
+    cache_path = os.path.join(cache_dir, MANIFEST_CACHE_FILE)
+    try:
+        with open(cache_path + '.tmp', 'w') as cache:
+            json.dump(MANIFEST_CACHE_USED, cache)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as e:
+        print(e)
+
+
+def read_manifest(manifest_fd, manifest_path):
+    try:
+        st = os.fstat(manifest_fd)
+        cached = MANIFEST_CACHE.get(manifest_path)
+        if (isinstance(cached, list) and len(cached) == 3 and isinstance(cached[2], dict)
+                and cached[0] == st.st_mtime_ns and cached[1] == st.st_size):
+            MANIFEST_CACHE_USED[manifest_path] = cached
+            return cached[2]
+        # Manifests are small, a raw read of st_size bytes avoids a TextIOWrapper per file
+        source = os.read(manifest_fd, st.st_size)
+    finally:
+        os.close(manifest_fd)
+    manifest = ast.parse(source, mode='eval').body
+    # Only these keys are used, evaluate just their values and keep the cache small
+    data = {
+        key.value: ast.literal_eval(value)
+        for key, value in zip(manifest.keys, manifest.values)
+        if isinstance(key, ast.Constant) and key.value in ('depends', 'external_dependencies')
+    }
+    MANIFEST_CACHE_USED[manifest_path] = [st.st_mtime_ns, st.st_size, data]
+    return data
+
+
+def scan_dir(dir_addons, order=()):
+    addons = []
+    subdirs = []
+    # Probe the children relative to the directory fd instead of resolving the full path each time
+    dir_fd = os.open(dir_addons, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        with os.scandir(dir_fd) as it:
+            dir_list = list(it)
+        if PRIORITY:
+            # Stable partition, priority entries first
+            dir_list = [t for t in dir_list if t.name in PRIORITY] + [t for t in dir_list if t.name not in PRIORITY]
+        for index, entry in enumerate(dir_list):
+            file_seek = entry.name
+            # is_dir(follow_symlinks=False) comes from the readdir data and is False for symlinks
+            if file_seek not in IGNORE and entry.is_dir(follow_symlinks=False):
+                check_file_directory = os.path.join(dir_addons, file_seek)
+                try:
+                    manifest_fd = os.open(f'{file_seek}/__manifest__.py', os.O_RDONLY, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    subdirs.append((check_file_directory, order + (index,)))
+                    continue
+                manifest_path = f'{check_file_directory}/__manifest__.py'
+                addons.append((order + (index,), (dir_addons, file_seek), read_manifest(manifest_fd, manifest_path)))
+    finally:
+        os.close(dir_fd)
+    return addons, subdirs
 
 
 def check_dir(dir_addons, links_seek=None, depends=None, main=None):
@@ -13,29 +100,50 @@ def check_dir(dir_addons, links_seek=None, depends=None, main=None):
     if links_seek is None:
         links_seek = []
     if main is None:
-        main = []
-    dir_list = os.listdir(dir_addons)
-    dir_list.sort(key=lambda t: t in set(PRIORITY), reverse=True)
-    for file_seek in dir_list:
-        check_file_directory = os.path.join(dir_addons, file_seek)
-        if os.path.isdir(check_file_directory) and not (file_seek in set(IGNORE)) and not os.path.islink(
-                check_file_directory):
-            manifest_path = os.path.join(check_file_directory, '__manifest__.py')
-            if os.path.exists(manifest_path):
-                links_seek.append((dir_addons, file_seek))
-                with open(manifest_path) as manifest:
-                    data = ast.literal_eval(manifest.read())
-                if data.get('depends'):
-                    for line in data['depends']:
-                        if line not in main:
-                            depends.update([line])
-            else:
-                links_seek, depends = check_dir(check_file_directory, links_seek, depends, main)
+        main = set()
+    found = []
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        pending = {executor.submit(scan_dir, dir_addons)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                addons, subdirs = future.result()
+                found += addons
+                pending.update(executor.submit(scan_dir, *subdir) for subdir in subdirs)
+    # Restore the depth-first, priority-first order of a sequential walk
+    found.sort(key=lambda addon: addon[0])
+    for order, link, data in found:
+        links_seek.append(link)
+        if data.get('depends'):
+            depends.update(line for line in data['depends'] if line not in main)
     return links_seek, depends
 
 
+def replaceable_symlink(name, source, source_dir, target_dir, dir_fd):
+    # Only swap links this script could have made: dangling ones or ones into source_dir
+    current = os.path.abspath(os.path.join(target_dir, os.readlink(name, dir_fd=dir_fd)))
+    if current == os.path.abspath(source):
+        return False
+    try:
+        os.stat(name, dir_fd=dir_fd)
+    except FileNotFoundError:
+        return True
+    source_root = os.path.abspath(source_dir)
+    return os.path.commonpath([current, source_root]) == source_root
+
+
+def replace_symlink(source, name, dir_fd):
+    # The new link is renamed over the old one, so the name never goes missing
+    tmp = f'.{name}.tmp'
+    try:
+        os.symlink(source, tmp, dir_fd=dir_fd)
+    except FileExistsError:
+        os.unlink(tmp, dir_fd=dir_fd)
+        os.symlink(source, tmp, dir_fd=dir_fd)
+    os.replace(tmp, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+
+
 if __name__ == '__main__':
-    addons = []
     source_dir = '/opt/odoo/odoo-16.0'
     target_dir = '/var/lib/odoo/.local/share/Odoo/addons'
     conf = sys.argv[1] or "/etc/odoo/odoo.conf"
@@ -44,23 +152,41 @@ if __name__ == '__main__':
     config.read(conf, "utf-8")
 
     if 'symlinks' in config.sections():
-        for key, value in config['symlinks'].items():
-            if key == 'source_dir':
-                source_dir = value
-            if key == 'target_dir':
-                target_dir = value
-            if key == 'priority':
-                PRIORITY += value.split(',')
+        symlinks = config['symlinks']
+        source_dir = symlinks.get('source_dir', source_dir)
+        target_dir = symlinks.get('target_dir', target_dir)
+        if symlinks.get('priority'):
+            PRIORITY = PRIORITY | frozenset(split_list(symlinks['priority']))
 
+    load_manifest_cache(target_dir)
     links, dependencies = check_dir(source_dir)
-    addons += list(dependencies)
-
-    for link in links:
-        source = os.path.join(link[0], link[1])
-        target = os.path.join(target_dir, link[1])
-        if link[1] not in addons:
-            continue
-        try:
-            os.symlink(source, target)
-        except FileExistsError:
-            print('Duplicate: {}'.format('/'.join(link)))
+    save_manifest_cache(target_dir)
+    addons = set(dependencies)
+
+    target_fd = os.open(target_dir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        with os.scandir(target_fd) as it:
+            existing = {entry.name: entry.is_symlink() for entry in it}
+        linked = set()
+        for link in links:
+            if link[1] not in addons:
+                continue
+            if link[1] in linked or existing.get(link[1]) is False:
+                print('Duplicate: {}'.format('/'.join(link)))
+                continue
+            linked.add(link[1])
+            source = os.path.join(link[0], link[1])
+            if link[1] in existing:
+                # Swap a stale link in place, anything else keeps the old duplicate handling
+                if replaceable_symlink(link[1], source, source_dir, target_dir, target_fd):
+                    replace_symlink(source, link[1], target_fd)
+                    print('Replaced: {}'.format('/'.join(link)))
+                else:
+                    print('Duplicate: {}'.format('/'.join(link)))
+                continue
+            try:
+                os.symlink(source, link[1], dir_fd=target_fd)
+            except FileExistsError:
+                print('Duplicate: {}'.format('/'.join(link)))
+    finally:
+        os.close(target_fd)
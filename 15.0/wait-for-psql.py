@@ -1,10 +1,38 @@
 #!/usr/bin/env python3
 import argparse
-import psycopg2
+import ctypes
+import math
+import socket
 import sys
 import time
 
 
+PQPING_OK = 0
+PQPING_ERRORS = {
+    1: 'server is running but rejecting connections',
+    2: 'could not establish connection',
+    3: 'no attempt made, bad connection parameters',
+}
+
+
+def load_pqping():
+    # libpq is already on the image for psycopg2, PQping checks readiness without opening a session
+    try:
+        libpq = ctypes.CDLL('libpq.so.5')
+    except OSError:
+        return None
+    libpq.PQping.argtypes = [ctypes.c_char_p]
+    libpq.PQping.restype = ctypes.c_int
+    return libpq.PQping
+
+
+def make_conninfo(**params):
+    return ' '.join(
+        "%s='%s'" % (key, str(value).replace('\\', '\\\\').replace("'", "\\'"))
+        for key, value in params.items()
+    )
+
+
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--db_host', required=True)
@@ -15,17 +43,36 @@ if __name__ == '__main__':
 
     args = arg_parser.parse_args()
 
+    pqping = load_pqping()
+    if pqping is None:
+        # Only the fallback needs psycopg2, skip importing it otherwise
+        import psycopg2
+        connect_errors = (OSError, psycopg2.OperationalError)
+    else:
+        connect_errors = OSError
     start_time = time.time()
+    delay = 0.1
     while (time.time() - start_time) < args.timeout:
         try:
-            conn = psycopg2.connect(user=args.db_user, host=args.db_host, port=args.db_port, password=args.db_password, dbname='postgres')
+            if not args.db_host.startswith('/'):
+                # A refused TCP connect fails much faster than a libpq handshake
+                socket.create_connection((args.db_host, int(args.db_port)), timeout=0.5).close()
+            if pqping is not None:
+                # PQping has no timeout of its own, cap each attempt by what is left of the budget
+                remaining = args.timeout - (time.time() - start_time)
+                conninfo = make_conninfo(host=args.db_host, port=args.db_port, user=args.db_user, dbname='postgres',
+                                         connect_timeout=max(1, math.ceil(remaining))).encode()
+                status = pqping(conninfo)
+                if status != PQPING_OK:
+                    raise ConnectionError(PQPING_ERRORS.get(status, 'PQping status %d' % status))
+            else:
+                psycopg2.connect(user=args.db_user, host=args.db_host, port=args.db_port, password=args.db_password, dbname='postgres').close()
             error = ''
             break
-        except psycopg2.OperationalError as e:
+        except connect_errors as e:
             error = e
-        else:
-            conn.close()
-        time.sleep(1)
+        time.sleep(delay)
+        delay = min(delay * 1.5, 2)
 
     if error:
         print("Database connection failure: %s" % error, file=sys.stderr)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import argparse
-import psycopg2
+import ctypes
+import math
+import socket
 import sys
 import time
 import logging
@@ -10,15 +12,49 @@ def get_module_logger(mod_name):
     To use this, do logger = get_module_logger(__name__)
     """
     logger = logging.getLogger(mod_name)
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter(
-        '%(asctime)s %(levelname) ? [%(filename)s:%(lineno)d]: %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        formatter = logging.Formatter(
+            '%(asctime)s %(levelname)s [%(filename)s:%(lineno)d]: %(message)s')
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
     return logger
 
 
+# The record format has no thread or process fields, skip collecting them
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+logger = get_module_logger(__name__)
+
+
+PQPING_OK = 0
+PQPING_ERRORS = {
+    1: 'server is running but rejecting connections',
+    2: 'could not establish connection',
+    3: 'no attempt made, bad connection parameters',
+}
+
+
+def load_pqping():
+    # libpq is already on the image for psycopg2, PQping checks readiness without opening a session
+    try:
+        libpq = ctypes.CDLL('libpq.so.5')
+    except OSError:
+        return None
+    libpq.PQping.argtypes = [ctypes.c_char_p]
+    libpq.PQping.restype = ctypes.c_int
+    return libpq.PQping
+
+
+def make_conninfo(**params):
+    return ' '.join(
+        "%s='%s'" % (key, str(value).replace('\\', '\\\\').replace("'", "\\'"))
+        for key, value in params.items()
+    )
+
+
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--db_host', required=True)
@@ -29,19 +65,38 @@ if __name__ == '__main__':
 
     args = arg_parser.parse_args()
 
+    pqping = load_pqping()
+    if pqping is None:
+        # Only the fallback needs psycopg2, skip importing it otherwise
+        import psycopg2
+        connect_errors = (OSError, psycopg2.OperationalError)
+    else:
+        connect_errors = OSError
     start_time = time.time()
+    delay = 0.1
     while (time.time() - start_time) < args.timeout:
         try:
-            conn = psycopg2.connect(user=args.db_user, host=args.db_host, port=args.db_port, password=args.db_password, dbname='postgres')
-            get_module_logger(__name__).info(f"Connected to {conn}")
+            if not args.db_host.startswith('/'):
+                # A refused TCP connect fails much faster than a libpq handshake
+                socket.create_connection((args.db_host, int(args.db_port)), timeout=0.5).close()
+            if pqping is not None:
+                # PQping has no timeout of its own, cap each attempt by what is left of the budget
+                remaining = args.timeout - (time.time() - start_time)
+                conninfo = make_conninfo(host=args.db_host, port=args.db_port, user=args.db_user, dbname='postgres',
+                                         connect_timeout=max(1, math.ceil(remaining))).encode()
+                status = pqping(conninfo)
+                if status != PQPING_OK:
+                    raise ConnectionError(PQPING_ERRORS.get(status, 'PQping status %d' % status))
+            else:
+                psycopg2.connect(user=args.db_user, host=args.db_host, port=args.db_port, password=args.db_password, dbname='postgres').close()
+            logger.info("Connected to %s:%s", args.db_host, args.db_port)
             error = ''
             break
-        except psycopg2.OperationalError as e:
+        except connect_errors as e:
             error = e
-        else:
-            conn.close()
-        time.sleep(1)
+        time.sleep(delay)
+        delay = min(delay * 1.5, 2)
 
     if error:
-        get_module_logger(__name__).info(f"Database connection failure: {error}")
+        logger.info("Database connection failure: %s", error)
         sys.exit(1)
@@ -3,74 +3,260 @@
 import configparser
 import os, sys
 import ast
+import re
+import functools
+import json
+import shutil
+import stat
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import subprocess
 import argparse
-import pkg_resources
+from importlib.metadata import distributions
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import canonicalize_name
 
+@functools.lru_cache(maxsize=1)
+def installed_distributions():
+    installed = {}
+    for dist in distributions():
+        name = dist.metadata['Name']
+        if name:
+            installed.setdefault(canonicalize_name(name), dist.version)
+    return installed
+
+
+@functools.lru_cache(maxsize=None)
 def should_install_requirement(requirement):
-    should_install = False
     try:
-        pkg_resources.require(requirement)
-    except (pkg_resources.DistributionNotFound, pkg_resources.VersionConflict):
-        should_install = True
-    return should_install
+        requirement = Requirement(requirement)
+    except InvalidRequirement:
+        # Let pip report it, the per-job fallback keeps it from failing the other requirements
+        return True
+    if requirement.marker and not requirement.marker.evaluate():
+        return False
+    version = installed_distributions().get(canonicalize_name(requirement.name))
+    if version is None:
+        return True
+    return bool(requirement.specifier) and not requirement.specifier.contains(version, prereleases=True)
+
+
+def requirement_file_satisfied(requirement_file):
+    # Only plain requirement lines can be checked here, anything else is left to pip
+    try:
+        with open(requirement_file) as requirements:
+            lines = [line.split('#', 1)[0].strip() for line in requirements]
+        return not any(should_install_requirement(line) for line in lines if line)
+    except OSError:
+        return False
 
 
-def install_packages(requirement_list):
+# These fail every job the same way, retrying them one by one would only repeat the error
+PIP_ENVIRONMENT_ERRORS = ('externally-managed-environment', 'due to an OSError')
+
+
+def install_batch(command, jobs):
+    result = subprocess.run(command + [arg for job in jobs for arg in job], stderr=subprocess.PIPE, universal_newlines=True)
+    sys.stderr.write(result.stderr)
+    if result.returncode != 0 and len(jobs) > 1 and not any(error in result.stderr for error in PIP_ENVIRONMENT_ERRORS):
+        # One broken requirement fails the whole batch, install what can be installed
+        for job in jobs:
+            subprocess.call(command + job)
+
+
+def install_packages(requirement_list, requirement_files=()):
     try:
-        requirements = [
-            requirement
+        jobs = [
+            [requirement]
             for requirement in requirement_list
             if should_install_requirement(requirement)
         ]
-        if len(requirements) > 0:
-            subprocess.call([sys.executable, '-m', 'pip', 'install', '--target', '/mnt/extra-addons', *requirements])
+        # requirements.txt files keep their own pip run, into site-packages and with their dependencies
+        file_jobs = [
+            ['-r', requirement_file]
+            for requirement_file in requirement_files
+            if not requirement_file_satisfied(requirement_file)
+        ]
+        if len(jobs) > 0 or len(file_jobs) > 0:
+            command = [sys.executable, '-m', 'pip', 'install', '--target', '/mnt/extra-addons']
+            if len(jobs) > 0:
+                install_batch(command, jobs)
+            if len(file_jobs) > 0:
+                install_batch([sys.executable, '-m', 'pip', 'install', '--ignore-installed'], file_jobs)
+            installed_distributions.cache_clear()
+            should_install_requirement.cache_clear()
         else:
             print("Requirements already satisfied.")
     except Exception as e:
         print(e)
 
-PRIORITY = []
-IGNORE = ['.git', 'setup', '.gitignore', '.idea']
+PRIORITY = frozenset()
+IGNORE = frozenset({'.git', 'setup', '.gitignore', '.idea'})
+SCAN_WORKERS = 16
 ADDONS = []
+LIST_SEPARATOR = re.compile(r'\s*,\s*')
+
+
+def split_list(value):
+    # Comma separated config values, tolerate spaces and empty items
+    return [item for item in LIST_SEPARATOR.split(value.strip()) if item]
+
+
+MANIFEST_CACHE = {}
+# Entries looked up this run, only these are saved so removed addons drop out of the cache
+MANIFEST_CACHE_USED = {}
+MANIFEST_CACHE_FILE = '.manifest_cache.json'
+
+
+def load_manifest_cache(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_CACHE_FILE)) as cache:
+            cached = json.load(cache)
+    except (OSError, ValueError):
+        return
+    if isinstance(cached, dict):
+        MANIFEST_CACHE.update(cached)
+
+
+def save_manifest_cache(cache_dir):
+    cache_path = os.path.join(cache_dir, MANIFEST_CACHE_FILE)
+    try:
+        with open(cache_path + '.tmp', 'w') as cache:
+            json.dump(MANIFEST_CACHE_USED, cache)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as e:
+        print(e)
+
+
+def read_manifest(manifest_fd, manifest_path):
+    try:
+        st = os.fstat(manifest_fd)
+        cached = MANIFEST_CACHE.get(manifest_path)
+        if (isinstance(cached, list) and len(cached) == 3 and isinstance(cached[2], dict)
+                and cached[0] == st.st_mtime_ns and cached[1] == st.st_size):
+            MANIFEST_CACHE_USED[manifest_path] = cached
+            return cached[2]
+        # Manifests are small, a raw read of st_size bytes avoids a TextIOWrapper per file
+        source = os.read(manifest_fd, st.st_size)
+    finally:
+        os.close(manifest_fd)
+    manifest = ast.parse(source, mode='eval').body
+    # Only these keys are used, evaluate just their values and keep the cache small
+    data = {
+        key.value: ast.literal_eval(value)
+        for key, value in zip(manifest.keys, manifest.values)
+        if isinstance(key, ast.Constant) and key.value in ('depends', 'external_dependencies')
+    }
+    MANIFEST_CACHE_USED[manifest_path] = [st.st_mtime_ns, st.st_size, data]
+    return data
+
+
+def scan_dir(dir_addons, order=()):
+    addons = []
+    subdirs = []
+    requirement_files = []
+    # Probe the children relative to the directory fd instead of resolving the full path each time
+    dir_fd = os.open(dir_addons, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        with os.scandir(dir_fd) as it:
+            dir_list = list(it)
+        if PRIORITY:
+            # Stable partition, priority entries first
+            dir_list = [t for t in dir_list if t.name in PRIORITY] + [t for t in dir_list if t.name not in PRIORITY]
+        for index, entry in enumerate(dir_list):
+            file_seek = entry.name
+            # is_dir(follow_symlinks=False) comes from the readdir data and is False for symlinks
+            if file_seek not in IGNORE and entry.is_dir(follow_symlinks=False):
+                check_file_directory = os.path.join(dir_addons, file_seek)
+                try:
+                    if stat.S_ISREG(os.stat(f'{file_seek}/requirements.txt', dir_fd=dir_fd).st_mode):
+                        requirement_files.append((order + (index,), f'{check_file_directory}/requirements.txt'))
+                except FileNotFoundError:
+                    pass
+                try:
+                    manifest_fd = os.open(f'{file_seek}/__manifest__.py', os.O_RDONLY, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    subdirs.append((check_file_directory, order + (index,)))
+                    continue
+                manifest_path = f'{check_file_directory}/__manifest__.py'
+                addons.append((order + (index,), (dir_addons, file_seek), read_manifest(manifest_fd, manifest_path)))
+    finally:
+        os.close(dir_fd)
+    return addons, subdirs, requirement_files
 
 
-def check_dir(dir_addons, links_seek=None, depends=None, main=None):
+def check_dir(dir_addons, links_seek=None, depends=None, main=None, requirements=None, requirement_files=None):
     if depends is None:
         depends = set()
+    if requirements is None:
+        requirements = set()
+    if requirement_files is None:
+        requirement_files = []
     if links_seek is None:
         links_seek = []
     if main is None:
-        main = []
-    dir_list = os.listdir(dir_addons)
-    dir_list.sort(key=lambda t: t in set(PRIORITY), reverse=True)
-    for file_seek in dir_list:
-        if os.path.isfile(os.path.join(file_seek, "requirements.txt")):
-            subprocess.call([sys.executable, '-m', 'pip', 'install', '--ignore-installed', '-r', os.path.join(file_seek, "requirements.txt")])
-        check_file_directory = os.path.join(dir_addons, file_seek)
-        if os.path.isdir(check_file_directory) and not (file_seek in set(IGNORE)) and not os.path.islink(
-                check_file_directory):
-            manifest_path = os.path.join(check_file_directory, '__manifest__.py')
-            if os.path.exists(manifest_path):
-                links_seek.append((dir_addons, file_seek))
-                with open(manifest_path) as manifest:
-                    data = ast.literal_eval(manifest.read())
-                if data.get('depends'):
-                    for line in data['depends']:
-                        if line not in main:
-                            depends.update([line])
-                if data.get('external_dependencies') and data['external_dependencies'].get('python'):
-                    install_packages(data['external_dependencies']['python'])
-            else:
-                links_seek, depends = check_dir(check_file_directory, links_seek, depends, main)
-    return links_seek, depends
+        main = set()
+    found = []
+    found_files = []
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        pending = {executor.submit(scan_dir, dir_addons)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                addons, subdirs, files = future.result()
+                found += addons
+                found_files += files
+                pending.update(executor.submit(scan_dir, *subdir) for subdir in subdirs)
+    # Restore the depth-first, priority-first order of a sequential walk
+    found.sort(key=lambda addon: addon[0])
+    found_files.sort()
+    requirement_files += [path for order, path in found_files]
+    for order, link, data in found:
+        links_seek.append(link)
+        if data.get('depends'):
+            depends.update(line for line in data['depends'] if line not in main)
+        if data.get('external_dependencies') and data['external_dependencies'].get('python'):
+            requirements.update(data['external_dependencies']['python'])
+    return links_seek, depends, requirements, requirement_files
 
 
 def install_oca_addons():
-    subprocess.call([sys.executable, '-m', 'pipx', 'install',
-                     'oca-maintainers-tools@git+https://github.com/OCA/maintainer-tools.git'])
-    os.chdir("/opt/odoo/odoo-16.0/oca")
-    subprocess.call([sys.executable, '/usr/local/bin/oca-clone-everything --target-branch', '16.0'])
+    if shutil.which('oca-clone-everything') is None:
+        subprocess.call([sys.executable, '-m', 'pipx', 'install',
+                         'oca-maintainers-tools@git+https://github.com/OCA/maintainer-tools.git'])
+    # pipx can fail (e.g. no write access to its bin dir), the rest of the setup must still run
+    oca_clone = shutil.which('oca-clone-everything')
+    if oca_clone is None:
+        print('oca-clone-everything is not available, skipping the OCA addons')
+        return
+    try:
+        os.chdir("/opt/odoo/odoo-16.0/oca")
+        subprocess.call([oca_clone, '--target-branch', '16.0'])
+    except OSError as e:
+        print(e)
+
+
+def replaceable_symlink(name, source, source_dir, target_dir, dir_fd):
+    # Only swap links this script could have made: dangling ones or ones into source_dir
+    current = os.path.abspath(os.path.join(target_dir, os.readlink(name, dir_fd=dir_fd)))
+    if current == os.path.abspath(source):
+        return False
+    try:
+        os.stat(name, dir_fd=dir_fd)
+    except FileNotFoundError:
+        return True
+    source_root = os.path.abspath(source_dir)
+    return os.path.commonpath([current, source_root]) == source_root
+
+
+def replace_symlink(source, name, dir_fd):
+    # The new link is renamed over the old one, so the name never goes missing
+    tmp = f'.{name}.tmp'
+    try:
+        os.symlink(source, tmp, dir_fd=dir_fd)
+    except FileExistsError:
+        os.unlink(tmp, dir_fd=dir_fd)
+        os.symlink(source, tmp, dir_fd=dir_fd)
+    os.replace(tmp, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
 
 
 if __name__ == '__main__':
@@ -101,7 +287,6 @@ if __name__ == '__main__':
     args = arg_parser.parse_args()
 
     config = False
-    addons = []
     source_dir = '/opt/odoo/odoo-16.0'
     target_dir = '/var/lib/odoo/.local/share/Odoo/addons'
 
@@ -116,28 +301,48 @@ if __name__ == '__main__':
         target_dir = args.target_dir
 
     if config and 'symlinks' in config.sections():
-        for key, value in config['symlinks'].items():
-            if key == 'source_dir':
-                source_dir = value
-            if key == 'target_dir':
-                target_dir = value
-            if key == 'priority':
-                PRIORITY += value.split(',')
+        symlinks = config['symlinks']
+        source_dir = symlinks.get('source_dir', source_dir)
+        target_dir = symlinks.get('target_dir', target_dir)
+        if symlinks.get('priority'):
+            PRIORITY = PRIORITY | frozenset(split_list(symlinks['priority']))
 
     if args.use_oca:
         install_oca_addons()
+    requirements = set()
     if args.odoo_addons_oca:
-        install_packages(args.odoo_addons_oca.split(','))
-
-    links, dependencies = check_dir(source_dir)
-    addons += list(dependencies)
-
-    for link in links:
-        source = os.path.join(link[0], link[1])
-        target = os.path.join(target_dir, link[1])
-        if link[1] not in addons:
-            continue
-        try:
-            os.symlink(source, target)
-        except FileExistsError:
-            print('Duplicate: {}'.format('/'.join(link)))
+        requirements.update(split_list(args.odoo_addons_oca))
+
+    load_manifest_cache(target_dir)
+    links, dependencies, requirements, requirement_files = check_dir(source_dir, requirements=requirements)
+    save_manifest_cache(target_dir)
+    install_packages(sorted(requirements), requirement_files)
+    addons = set(dependencies)
+
+    target_fd = os.open(target_dir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        with os.scandir(target_fd) as it:
+            existing = {entry.name: entry.is_symlink() for entry in it}
+        linked = set()
+        for link in links:
+            if link[1] not in addons:
+                continue
+            if link[1] in linked or existing.get(link[1]) is False:
+                print('Duplicate: {}'.format('/'.join(link)))
+                continue
+            linked.add(link[1])
+            source = os.path.join(link[0], link[1])
+            if link[1] in existing:
+                # Swap a stale link in place, anything else keeps the old duplicate handling
+                if replaceable_symlink(link[1], source, source_dir, target_dir, target_fd):
+                    replace_symlink(source, link[1], target_fd)
+                    print('Replaced: {}'.format('/'.join(link)))
+                else:
+                    print('Duplicate: {}'.format('/'.join(link)))
+                continue
+            try:
+                os.symlink(source, link[1], dir_fd=target_fd)
+            except FileExistsError:
+                print('Duplicate: {}'.format('/'.join(link)))
+    finally:
+        os.close(target_fd)